@@ -2,8 +2,6 @@ import os
 import threading
 from pathlib import Path
 
-import configparser
-
 # This is what we use as our important settings config.
 # It's a bit heavy handed with the lock and aggressive saving, but these
 # settings are important, and not accessed much.
@@ -31,19 +29,23 @@ class Config:
     SagePrefixStringKey = "sage_prefix"
 
     # This allows us to add comments into our config.
-    # The objects must have two parts, first, a string they target. If the string is found, the comment will be inserted above the target string. This can be a section or value.
-    # A string, which is the comment to be inserted.
-    c_ConfigComments = [
-        { "Target": HaIpOrHostnameKey,  "Comment": "This is the IP or hostname used to connect to Home Assistant."},
-        { "Target": HaPortKey,  "Comment": "This is the port used to connect to Home Assistant."},
-        { "Target": HaUseHttps,  "Comment": "True or false if the ip/port requires https."},
-        { "Target": HaAccessTokenKey,  "Comment": "Required for standalone addon installs, not required for addon installs. This is the long lived access token used to connect to Home Assistant."},
-        { "Target": LogLevelKey,  "Comment": "The active logging level. Valid values include: DEBUG, INFO, WARNING, or ERROR."},
-        { "Target": SagePrefixStringKey,  "Comment": "If set, this will prefix the Sage services names with the given string, which is helpful if you run multiple instances of Homeway. This should not have spaces!."},
-    ]
-
-    # The config lib we use doesn't support the % sign, even though it's valid .cfg syntax.
+    # Each entry is a pair, first, a string they target. If the string is found, the comment will be inserted above the target string. This can be a section or value.
+    # Second, a string, which is the comment to be inserted.
+    c_ConfigComments = (
+        (HaIpOrHostnameKey, "This is the IP or hostname used to connect to Home Assistant."),
+        (HaPortKey, "This is the port used to connect to Home Assistant."),
+        (HaUseHttps, "True or false if the ip/port requires https."),
+        (HaAccessTokenKey, "Required for standalone addon installs, not required for addon installs. This is the long lived access token used to connect to Home Assistant."),
+        (LogLevelKey, "The active logging level. Valid values include: DEBUG, INFO, WARNING, or ERROR."),
+        (SagePrefixStringKey, "If set, this will prefix the Sage services names with the given string, which is helpful if you run multiple instances of Homeway. This should not have spaces!."),
+    )
+
+    # The comments above, pre-formatted into the full line we write, so the save loop doesn't need to build them.
+    c_ConfigCommentLines = tuple((target, "# " + comment + os.linesep) for target, comment in c_ConfigComments)
+
+    # The config lib we used to use didn't support the % sign, even though it's valid .cfg syntax.
     # Since we save URLs into the config for the webcam, it's valid syntax to use a %20 and such, thus we should support it.
+    # Our own parser doesn't care, but we keep the placeholder so existing config files are still read correctly.
     PercentageStringReplaceString = "~~~PercentageSignPlaceholder~~~"
 
     def __init__(self, storageDir) -> None:
@@ -57,6 +59,10 @@ class Config:
         # A lock to keep file access super safe
         self.ConfigLock = threading.Lock()
         self.Config = None
+        # A read only copy of the config values, rebuilt under the lock every time the config is loaded or saved.
+        # The generation is bumped after each new snapshot is set, so readers can get values without taking the lock.
+        self._Snapshot:dict = None
+        self._Generation = 0
         # Load the config on init, to ensure it exists.
         # This will throw if there's an error reading the config.
         self._LoadConfigIfNeeded_UnderLock()
@@ -77,24 +83,51 @@ class Config:
     # Gets a value from the config given the header and key.
     # If the value isn't set, the default value is returned and the default value is saved into the config.
     def GetStr(self, section, key, defaultValue) -> str:
+        # Fast path, try to read the value from the snapshot without taking the lock.
+        value = self._GetStrFromSnapshot(section, key)
+        if value is not None:
+            return value
         with self.ConfigLock:
             # Ensure we have the config.
             self._LoadConfigIfNeeded_UnderLock()
             # Check if the section and key exists
-            if self.Config.has_section(section):
-                if key in self.Config[section].keys():
-                    # If the value of None was written, it was an accidental serialized None value to string.
-                    # Consider it not a valid value, and use the default value.
-                    value = self.Config[section][key]
-                    if value != "None":
-                        # Reverse any possible string replaces we had to add.
-                        value = value.replace(Config.PercentageStringReplaceString, "%")
-                        return value
+            sectionValues = self.Config.get(section, None)
+            if sectionValues is not None:
+                value = sectionValues.get(key, None)
+                # If the value of None was written, it was an accidental serialized None value to string.
+                # Consider it not a valid value, and use the default value.
+                if value is not None and value != "None":
+                    # Reverse any possible string replaces we had to add.
+                    value = value.replace(Config.PercentageStringReplaceString, "%")
+                    return value
         # The value wasn't set, create it using the default.
         self.SetStr(section, key, defaultValue)
         return defaultValue
 
 
+    # Tries to get a value from the snapshot without taking the lock.
+    # Returns None if the value isn't set or if the snapshot changed while we were reading, in which case the caller should use the lock.
+    def _GetStrFromSnapshot(self, section, key) -> str:
+        # We will retry once if a writer swapped the snapshot while we were reading it.
+        for _ in range(2):
+            g1 = self._Generation
+            snapshot = self._Snapshot
+            g2 = self._Generation
+            if g1 != g2:
+                continue
+            if snapshot is None:
+                return None
+            sectionValues = snapshot.get(section, None)
+            if sectionValues is None:
+                return None
+            value = sectionValues.get(key, None)
+            # If the value of None was written, it was an accidental serialized None value to string.
+            if value is None or value == "None":
+                return None
+            return value.replace(Config.PercentageStringReplaceString, "%")
+        return None
+
+
     # Gets a value from the config given the header and key.
     # If the value isn't set, the default value is returned and the default value is saved into the config.
     def GetInt(self, section, key, defaultValue) -> int:
@@ -161,24 +194,41 @@ class Config:
     # Sets the value into the config and saves it.
     # Setting a value of None will delete the key from the config.
     def SetStr(self, section, key, value) -> None:
+        with self.ConfigLock:
+            self._LoadConfigIfNeeded_UnderLock()
+            self._SetStr_UnderLock(section, key, value)
+            self._SaveConfig_UnderLock()
+
+
+    # Sets many values into the config and saves it only once.
+    # The updates are a dict of sections, where each section is a dict of key value pairs.
+    # Just like SetStr, setting a value of None will delete the key from the config.
+    def SetMany(self, updates:dict) -> None:
+        with self.ConfigLock:
+            self._LoadConfigIfNeeded_UnderLock()
+            for section, values in updates.items():
+                for key, value in values.items():
+                    self._SetStr_UnderLock(section, key, value)
+            self._SaveConfig_UnderLock()
+
+
+    def _SetStr_UnderLock(self, section, key, value) -> None:
         # Ensure the value is a string, unless it's None
         if value is not None:
             value = str(value)
-            # The config library we use doesn't allow for % to be used in strings, even though it should be legal.
+            # Keep escaping % so the config stays compatible with older versions of the addon.
             value = value.replace("%", Config.PercentageStringReplaceString)
-        with self.ConfigLock:
-            self._LoadConfigIfNeeded_UnderLock()
-            # Ensure the section exists
-            if self.Config.has_section(section) is False:
-                self.Config.add_section(section)
-            if value is None:
-                # If we are setting to None, delete the key if it exists.
-                if key in self.Config[section].keys():
-                    del self.Config[section][key]
-            else:
-                # If not none, set the key
-                self.Config[section][key] = value
-            self._SaveConfig_UnderLock()
+        # Ensure the section exists, and take a reference to it so we only look it up once.
+        sectionValues = self.Config.get(section, None)
+        if sectionValues is None:
+            sectionValues = {}
+            self.Config[section] = sectionValues
+        if value is None:
+            # If we are setting to None, delete the key if it exists.
+            sectionValues.pop(key, None)
+        else:
+            # If not none, set the key
+            sectionValues[key] = value
 
 
     def _LoadConfigIfNeeded_UnderLock(self, forceRead = False) -> None:
@@ -186,43 +236,120 @@ class Config:
             return
 
         # Always create a new object.
-        # For our config, we use strict and such, so we know the config is valid.
-        self.Config = configparser.ConfigParser()
+        self.Config = {}
 
         # If a config exists, read it.
         # This will throw on failure.
         if os.path.exists(self.ConfigFilePath):
-            self.Config.read(self.ConfigFilePath)
+            with open(self.ConfigFilePath, 'r', encoding="utf-8") as f:
+                self.Config = Config._ParseConfig(f.read())
+            self._UpdateSnapshot_UnderLock()
         else:
             # If no config exists, create a new file by writing the empty config now.
             print("Config file doesn't exist. Creating a new file now!")
             self._SaveConfig_UnderLock()
 
 
+    # Builds a new read only copy of the config values and publishes it for the lock free readers.
+    def _UpdateSnapshot_UnderLock(self) -> None:
+        if self.Config is None:
+            return
+        snapshot = {}
+        for section, values in self.Config.items():
+            snapshot[section] = dict(values)
+        self._Snapshot = snapshot
+        self._Generation += 1
+
+
     def _SaveConfig_UnderLock(self) -> None:
         if self.Config is None:
             return
 
-        # Write the current settings to the file.
-        # This lets the config lib format everything how it wants.
-        with open(self.ConfigFilePath, 'w', encoding="utf-8") as f:
-            self.Config.write(f)
-
-        # After writing, read the file and insert any comments we have.
-        finalOutput = ""
-        with open(self.ConfigFilePath, 'r', encoding="utf-8") as f:
-            # Read all lines
-            lines = f.readlines()
-            for line in lines:
-                lineLower = line.lower()
-                # If anything in the line matches the target, add the comment just before this line.
-                for cObj in Config.c_ConfigComments:
-                    if cObj["Target"] in lineLower:
-                        # Add the comment.
-                        finalOutput += "# " + cObj["Comment"] + os.linesep
-                        break
-                finalOutput += line
-
-        # Finally, write the file back one more time.
-        with open(self.ConfigFilePath, 'w', encoding="utf-8") as f:
+        # Build the final file in memory and insert any comments we have.
+        output = []
+        for line in Config._SerializeConfig(self.Config).splitlines(keepends=True):
+            lineLower = line.lower()
+            # If anything in the line matches the target, add the comment just before this line.
+            for target, commentLine in Config.c_ConfigCommentLines:
+                if target in lineLower:
+                    output.append(commentLine)
+                    break
+            output.append(line)
+        finalOutput = "".join(output)
+
+        # Write the file to a temp file and then swap it in, so if we crash mid write the config isn't left half written.
+        tempFilePath = self.ConfigFilePath + ".tmp"
+        with open(tempFilePath, 'w', encoding="utf-8") as f:
             f.write(finalOutput)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempFilePath, self.ConfigFilePath)
+
+        # Publish the new values to the readers.
+        self._UpdateSnapshot_UnderLock()
+
+
+    # Parses the config file text into a dict of sections, where each section is a dict of key value pairs.
+    # Our config has a fixed and simple schema, so we don't need the full configparser, which is a lot slower.
+    # This follows the same rules configparser did for our files, keys are lower case, values are stripped,
+    # and lines indented more than the line a value started on continue that value.
+    # This will throw if the config isn't valid.
+    @staticmethod
+    def _ParseConfig(text:str) -> dict:
+        config = {}
+        section = None
+        key = None
+        keyIndent = 0
+        for line in text.splitlines():
+            s = line.strip()
+            # Skip comments, they don't end a multi line value.
+            if len(s) > 0 and (s[0] == '#' or s[0] == ';'):
+                continue
+            # Like configparser, empty lines are kept in a multi line value. Any trailing empty lines are stripped at the end.
+            if len(s) == 0:
+                if key is not None:
+                    section[key] += "\n"
+                continue
+            # Like configparser, a line indented more than the line the value started on continues that value on a new line.
+            indent = len(line) - len(line.lstrip())
+            if key is not None and indent > keyIndent:
+                section[key] += "\n" + s
+                continue
+            keyIndent = indent
+            # Section headers
+            if s[0] == '[':
+                if s[-1] != ']':
+                    raise Exception("Invalid config section header: "+s)
+                section = config.setdefault(s[1:-1].strip(), {})
+                key = None
+                continue
+            if section is None:
+                raise Exception("Config value found before any section header: "+s)
+            # Values can use = or :, whichever comes first.
+            eq = s.find('=')
+            colon = s.find(':')
+            if eq == -1 or (colon != -1 and colon < eq):
+                eq = colon
+            if eq == -1:
+                raise Exception("Invalid config line: "+s)
+            key = s[:eq].strip().lower()
+            section[key] = s[eq+1:].strip()
+        # Strip any empty lines that were added to the end of the values.
+        for values in config.values():
+            for k, v in values.items():
+                values[k] = v.rstrip()
+        return config
+
+
+    # Serializes the config dict into the same format configparser used.
+    @staticmethod
+    def _SerializeConfig(config:dict) -> str:
+        lines = []
+        for section, values in config.items():
+            lines.append("[" + section + "]")
+            for key, value in values.items():
+                # Multi line values are written with indented continuation lines, the same as configparser.
+                lines.append(key + " = " + value.replace("\n", "\n\t"))
+            lines.append("")
+        lines.append("")
+        return "\n".join(lines)
@@ -1,4 +1,7 @@
 import os
+import re
+import mmap
+import stat
 import logging
 import threading
 import time
@@ -24,11 +27,68 @@ class ConfigManager:
     # Since we will ping the plugin to force the restart before we setup an assistant, this can be a while.
     c_TimeToIdleSec = 60 * 60 * 5
 
-
-    def __init__(self, logger:logging.Logger) -> None:
+    # How long we will use a cached result from the HA config API before asking again.
+    c_ConfigApiCacheTtlSec = 60 * 5
+
+    # If the HA config API call fails, how long we wait before trying it again.
+    c_ConfigApiFailureRetrySec = 10
+
+    # How long we will trust the config path found from the HA API before checking it's still on disk.
+    c_ResolvedConfigFilePathTtlSec = 60
+
+    # The configs we add to enable the assistants.
+    # It's important to get the indents correct, or we will break the config.
+    c_ConfigLineEnding = b"\r\n"
+    c_AlexaConfigBlock = (
+        b"# Added By Homeway to enable Alexa support.\r\n"
+        b"alexa:\r\n"
+        b"  smart_home:\r\n"
+    )
+    c_GoogleAssistantConfigBlock = (
+        b"# Added By Homeway to enable Google Assistant support.\r\n"
+        b"google_assistant:\r\n"
+        b"  project_id: homewayio\r\n"
+        b"  service_account:\r\n"
+        b"    private_key: \"nokey\"\r\n"
+        b"    client_email: \"support@homeway.io\"\r\n"
+    )
+
+    # The config is parsed as bytes, since all of the keys we look for are ASCII and it saves decoding the whole file.
+    # Finds the top level sections we care about, anywhere in the file.
+    c_SectionStartRegex = re.compile(rb"^(http|alexa|google_assistant):", re.IGNORECASE | re.MULTILINE)
+    # Classifies each line in the http section with a single match, the named group that matched tells us what the line is.
+    #   top - Any top level line that isn't a comment, which means a new section started.
+    #   serverPort - A server_port line, with the port value in the port group if it could be parsed. Trailing comments are allowed.
+    c_HttpSectionLineRegex = re.compile(rb"(?:(?P<top>[^\s#])|(?P<serverPort>[ \t]+server_port)\b(?:[ \t]*:[ \t]*(?P<port>\d+)\s*(?:#.*)?$)?)", re.IGNORECASE)
+
+
+    # The HA connection can be passed here if it already exists, otherwise it must be set later with SetHaConnection.
+    def __init__(self, logger:logging.Logger, haCon:Connection = None) -> None:
         self.Logger = logger
-        self.HaConnection = None
-        self.RestartRequired = False
+        self.HaConnection = haCon
+        # Set when we changed the config and HA needs to be restarted to apply it.
+        self._RestartRequired = threading.Event()
+        # Caches the parse results of the config file, keyed by the file path.
+        # Each entry is (st_mtime_ns, st_size, st_ino, parseResult), so we only read the file again if it changed on disk.
+        # The inode is included so a file that was replaced (like an atomic save from an editor) is always read again.
+        self._ConfigCache = {}
+        self._ConfigCacheLock = threading.Lock()
+        # Once we find the config file in the container location, we remember it, since the container mapping doesn't change while we are running.
+        # Only a hit is remembered, so a miss is checked again next time. This is only ever set from None to the path, so it's safe across threads without a lock.
+        self._ContainerConfigFilePath = None
+        # Once we find the config path from the HA API, we remember it so we don't need to look it up again.
+        self._ResolvedConfigFilePath = None
+        self._ResolvedConfigFilePathCheckedAt = 0.0
+        # Caches the last successful HA config API result, until the expiry time.
+        self._ConfigApiCache = None
+        self._ConfigApiCacheExpiry = 0.0
+        self._ConfigApiRetryAfter = 0.0
+        # The thread waiting to do the pending HA restart, if there is one.
+        # The wake event is set when the deadline moves sooner, so the waiting thread picks up the new deadline.
+        self._RestartLock = threading.Lock()
+        self._WakeRestart = threading.Event()
+        self._RestartThread:threading.Thread = None
+        self._RestartDeadline = 0.0
         CommandHandler.Get().RegisterConfigManager(self)
 
 
@@ -41,9 +101,9 @@ class ConfigManager:
     # If we need a restart, return true and do it
     # Otherwise, return false.
     def NeedsRestart(self) -> bool:
-        if self.RestartRequired is False:
+        if self._RestartRequired.is_set() is False:
             return False
-        # Kick off a restart on a new thread.
+        # Move the pending restart up, or start one if there isn't one.
         # We want to give this command time to return back the http response and then restart.
         self.RestartHomeAssistant(2.0)
         return True
@@ -57,14 +117,9 @@ class ConfigManager:
         configPath = self._GetConfigFilePath(True)
         if configPath is None:
             return False
-        # Make sure we can open it, assume we can write it.
-        try:
-            with open(configPath, encoding="utf-8") as f:
-                f.readline()
-                return True
-        except Exception:
-            pass
-        return False
+        # Make sure we can read and write it, this is a single syscall and doesn't need to open the file.
+        # The config is updated by appending to the file in place, so this is all the access we need.
+        return os.access(configPath, os.R_OK | os.W_OK)
 
 
     # Reads the http port out of the config, if there is one.
@@ -78,36 +133,7 @@ class ConfigManager:
 
             # Look for the http port
             # https://www.home-assistant.io/integrations/http/
-            with open(configFilePath, encoding="utf-8") as f:
-                # We tired to use the yaml library for parsing, but there's uncommon syntax in the HA config that will break it.
-                foundHttpSection = False
-                lines = f.readlines()
-                for l in lines:
-                    # Skip empty lines
-                    if len(l) == 0:
-                        continue
-                    lineLower = l.lower()
-                    # Basic idea:
-                    #   Find the "http:" section
-                    #   After we find the http section, if we find a line matching the server port, try to parse it out.
-                    #   After we find the http section, if we see any line that starts with a char or number it's a new section, so we are done.
-                    # If we found the http section, any line that starts with a letter or number is a new section, so we are done.
-                    if foundHttpSection and lineLower[0].isalnum():
-                        return None
-                    # Search for the http section.
-                    if lineLower.startswith("http:"):
-                        self.Logger.debug("ConfigManager.ReadHttpPort Found the http section.")
-                        foundHttpSection = True
-                    # Search for the line with the port number.
-                    if foundHttpSection and lineLower.find("server_port") != -1:
-                        self.Logger.debug("ConfigManager.ReadHttpPort Found the server_port %s", l)
-                        # We found the line, find the separator
-                        if lineLower.find(":") == -1:
-                            self.Logger.warn(f"We found the server_port line, but it's not formatted correctly. We can't parse it. {l}")
-                            return None
-                        # After the : should only be an int.
-                        parts = lineLower.split(":")
-                        return int(parts[1].strip())
+            return self._ParseConfig(configFilePath)[0]
         except Exception as e:
             self.Logger.error(f"Exception in ConfigManager.ReadHttpPort. {e}")
         return None
@@ -123,84 +149,109 @@ class ConfigManager:
                 self.Logger.warn("UpdateConfigIfNeeded failed to get a config file path.")
                 return
 
-            # Open the file and read.
-            foundGoogleAssistantConfig = False
-            foundAlexaConfig = False
-            with open(configFilePath, 'r', encoding="utf-8") as f:
-                # Look for the starting lines of the configs, since they must be exact.
-                # But remember they will have line endings, so we use startwith.
-                lines = f.readlines()
-                for l in lines:
-                    lineLower = l.lower()
-                    if lineLower.startswith("google_assistant:"):
-                        foundGoogleAssistantConfig = True
-                    if lineLower.startswith("alexa:"):
-                        foundAlexaConfig = True
-
+            # First check which configs already exist with a read only parse, which uses the cache if the file hasn't changed.
+            # This way we don't need write access to the file if there's nothing to add.
+            _, foundAlexaConfig, foundGoogleAssistantConfig = self._ParseConfig(configFilePath)
             if foundGoogleAssistantConfig and foundAlexaConfig:
                 self.Logger.info("Google Assistant and Alexa configs found, no need to add them.")
                 return
 
-            # Add which ever is needed.
-            # It's important to get the indents correct, or we will break the config.
-            linesToAppend = []
-            lineEnding = "\r\n"
-
-            # Add a new line to start
-            linesToAppend.append(lineEnding)
-
-            if foundAlexaConfig is False:
-                linesToAppend.append("# Added By Homeway to enable Alexa support."+lineEnding)
-                linesToAppend.append("alexa:"+lineEnding)
-                linesToAppend.append("  smart_home:"+lineEnding)
-
-            if foundGoogleAssistantConfig is False:
-                # If we added the alexa config, add a new line to separate them.
+            # Something needs to be added, so open the file for the append.
+            with open(configFilePath, 'r+b') as f:
+                # Check again from this handle, in case the file changed since the parse above.
+                st = os.fstat(f.fileno())
+                result = self._GetConfigCache(configFilePath, st)
+                if result is None:
+                    result = self._ParseConfigFile(configFilePath, f, st)
+                httpPort, foundAlexaConfig, foundGoogleAssistantConfig = result
+
+                if foundGoogleAssistantConfig and foundAlexaConfig:
+                    self.Logger.info("Google Assistant and Alexa configs found, no need to add them.")
+                    return
+
+                # Add which ever is needed, starting and ending with a new line.
+                # If we add both, add a new line to separate them.
+                lineEnding = ConfigManager.c_ConfigLineEnding
+                payload = lineEnding
                 if foundAlexaConfig is False:
-                    linesToAppend.append(lineEnding)
-                linesToAppend.append("# Added By Homeway to enable Google Assistant support."+lineEnding)
-                linesToAppend.append("google_assistant:"+lineEnding)
-                linesToAppend.append("  project_id: homewayio"+lineEnding)
-                linesToAppend.append("  service_account:"+lineEnding)
-                linesToAppend.append("    private_key: \"nokey\""+lineEnding)
-                linesToAppend.append("    client_email: \"support@homeway.io\""+lineEnding)
-
-            # Add a new line to the end
-            linesToAppend.append(lineEnding)
-
-            # Add the config lines.
-            with open(configFilePath, 'a', encoding="utf-8") as f:
-                f.writelines(linesToAppend)
+                    payload += ConfigManager.c_AlexaConfigBlock
+                if foundAlexaConfig is False and foundGoogleAssistantConfig is False:
+                    payload += lineEnding
+                if foundGoogleAssistantConfig is False:
+                    payload += ConfigManager.c_GoogleAssistantConfigBlock
+                payload += lineEnding
+
+                # Add the config lines, and make sure they are on disk before we restart HA to load them.
+                # This appends in place rather than swapping in a new file, so it works when only the file is writable or bind mounted,
+                # and the file keeps the same inode for anything else that has it open.
+                f.seek(0, os.SEEK_END)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+                # Update the cache with what we just wrote, so the next read doesn't need to go back to the file.
+                # The new configs are appended after everything else, so the http port can't change.
+                self._UpdateConfigCache(configFilePath, os.fstat(f.fileno()), (httpPort, True, True))
 
             self.Logger.info(f"Config file updated with assistant configs. Alexa: {str(foundAlexaConfig is False)}, Google Assistant: {str(foundGoogleAssistantConfig is False)}")
 
             # Start a refresh thread.
-            self.RestartRequired = True
+            self._RestartRequired.set()
             self.RestartHomeAssistant(ConfigManager.c_TimeToIdleSec)
         except Exception as e:
+            # Don't trust the cached API result after a failure, get a fresh one next time.
+            self._ConfigApiCache = None
             Sentry.Exception("HomeAssistantConfigManager exception.", e)
 
 
+    # Schedules a Home Assistant restart after the given delay.
+    # There's only ever one pending restart, if one is already scheduled sooner, it's kept.
+    # Otherwise the waiting thread is woken up to use the new deadline.
     def RestartHomeAssistant(self, restartInSec:float):
-        t = threading.Thread(target=self._RestartHomeAssistant_Thread, args=(restartInSec,))
-        t.daemon = True
-        t.start()
-
-
-    def _RestartHomeAssistant_Thread(self, restartInSec:float):
-        try:
-            self.Logger.info(f"Waiting to restart HA for {restartInSec}...")
-            time.sleep(restartInSec)
-
-            # Ensure we still need the restart, there might have been another thread started that did it while we were waiting.
-            if self.RestartRequired is False:
-                self.Logger.info("No need to restart any longer. Not taking action.")
+        with self._RestartLock:
+            deadline = time.monotonic() + restartInSec
+            if self._RestartThread is not None:
+                if self._RestartDeadline <= deadline:
+                    self.Logger.info(f"A HA restart is already scheduled sooner than {restartInSec}, keeping it.")
+                    return
+                self.Logger.info(f"Moving the pending HA restart up to {restartInSec}...")
+                self._RestartDeadline = deadline
+                self._WakeRestart.set()
                 return
-            self.RestartRequired = False
+            self.Logger.info(f"Waiting to restart HA for {restartInSec}...")
+            self._RestartDeadline = deadline
+            self._RestartThread = threading.Thread(target=self._RestartHomeAssistant_Thread)
+            self._RestartThread.daemon = True
+            self._RestartThread.start()
+
+
+    def _RestartHomeAssistant_Thread(self):
+        # Wait until the deadline, which can be moved sooner while we are waiting.
+        while True:
+            with self._RestartLock:
+                remainingSec = self._RestartDeadline - time.monotonic()
+                if remainingSec <= 0:
+                    # Once we clear this, any new request will start a new thread.
+                    self._RestartThread = None
+                    break
+                self._WakeRestart.clear()
+            self._WakeRestart.wait(remainingSec)
+        self._DoRestartHomeAssistant()
+
+
+    def _DoRestartHomeAssistant(self):
+        try:
+            # Ensure we still need the restart, it might have already been done.
+            # The check and clear are done under the lock, so only one restart can ever claim the flag.
+            with self._RestartLock:
+                if self._RestartRequired.is_set() is False:
+                    self.Logger.info("No need to restart any longer. Not taking action.")
+                    return
+                self._RestartRequired.clear()
 
             # Ensure we have a con object.
             if self.HaConnection is None:
                 self.Logger.error("We wanted to restart Home Assistant but we don't have a ha connection object.")
+                return
 
             self.Logger.info("Trying to restart Home Assistant to apply the config change.")
             self.HaConnection.RestartHa()
@@ -208,50 +259,191 @@ class ConfigManager:
             Sentry.Exception("TryToRestartHomeAssistant exception.", e)
 
 
+    # Parses the config file and returns (httpPort, hasAlexaConfig, hasGoogleAssistantConfig).
+    # The http port will be None if it's not set. The file is only read and parsed again if it changed on disk.
+    # This will throw if the file can't be read.
+    def _ParseConfig(self, path:str):
+        st = os.stat(path)
+        cached = self._GetConfigCache(path, st)
+        if cached is not None:
+            return cached
+        with open(path, 'rb') as f:
+            return self._ParseConfigFile(path, f, st)
+
+
+    # Parses an already open config file and caches the result, given the stat result of the open file.
+    def _ParseConfigFile(self, path:str, f, st:os.stat_result):
+        # mmap can't map an empty file.
+        if st.st_size == 0:
+            return self._UpdateConfigCache(path, st, (None, False, False))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return self._UpdateConfigCache(path, st, self._ParseConfigBuffer(mm))
+
+
+    # Returns the cached parse result for the file if it matches the given stat result, otherwise None.
+    def _GetConfigCache(self, path:str, st:os.stat_result):
+        with self._ConfigCacheLock:
+            cached = self._ConfigCache.get(path, None)
+            if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size and cached[2] == st.st_ino:
+                return cached[3]
+        return None
+
+
+    # Sets the parse result for the file into the cache, given the stat result that matches it.
+    def _UpdateConfigCache(self, path:str, st:os.stat_result, result):
+        with self._ConfigCacheLock:
+            self._ConfigCache[path] = (st.st_mtime_ns, st.st_size, st.st_ino, result)
+        return result
+
+
+    # Finds everything we care about in the config file buffer.
+    # Returns (httpPort, hasAlexaConfig, hasGoogleAssistantConfig)
+    def _ParseConfigBuffer(self, mm:mmap.mmap):
+        # We tired to use the yaml library for parsing, but there's uncommon syntax in the HA config that will break it.
+        # Basic idea:
+        #   Find the start lines of the sections we care about, since they must be exact. This is done in one regex scan over the whole buffer.
+        #   After we find the http section, if we find a line matching the server port, try to parse it out.
+        #   After we find the http section, if we see any line that starts with something other than whitespace or a comment it's a new section, so we are done.
+        foundAlexaConfig = False
+        foundGoogleAssistantConfig = False
+        httpSectionEnd = -1
+        for m in ConfigManager.c_SectionStartRegex.finditer(mm):
+            section = m.group(1).lower()
+            if section == b"alexa":
+                foundAlexaConfig = True
+            elif section == b"google_assistant":
+                foundGoogleAssistantConfig = True
+            elif httpSectionEnd == -1:
+                self.Logger.debug("ConfigManager Found the http section.")
+                httpSectionEnd = m.end()
+            # Once we have found everything, there's no need to scan the rest of the file.
+            if foundAlexaConfig and foundGoogleAssistantConfig and httpSectionEnd != -1:
+                break
+        if httpSectionEnd == -1:
+            return (None, foundAlexaConfig, foundGoogleAssistantConfig)
+
+        # Walk the lines of the http section, skipping the rest of the http: line.
+        # The regex match and readline are bound to locals, since they are called for every line.
+        lineMatch = ConfigManager.c_HttpSectionLineRegex.match
+        readline = mm.readline
+        mm.seek(httpSectionEnd)
+        readline()
+        for l in iter(readline, b""):
+            m = lineMatch(l)
+            if m is None:
+                continue
+            if m.group("top") is not None:
+                break
+            # This is a server_port line in the http section.
+            # Only decode the line for logging if debug logging is on, since it's off by default.
+            if self.Logger.isEnabledFor(logging.DEBUG):
+                self.Logger.debug("ConfigManager Found the server_port %s", l.decode("utf-8", "replace"))
+            port = m.group("port")
+            if port is None:
+                self.Logger.warn(f"We found the server_port line, but it's not formatted correctly. We can't parse it. {l.decode('utf-8', 'replace')}")
+                continue
+            return (int(port), foundAlexaConfig, foundGoogleAssistantConfig)
+        return (None, foundAlexaConfig, foundGoogleAssistantConfig)
+
+
     # Returns the config file path for the Home Assistant config.
     # This will try a few paths on disk and also try the HA API to get it, if possible.
     # If the config path can't be found, None is returned.
-    # If a string is returned, it will always be a valid file path.
+    # If a string is returned, it was a valid file path when it was found.
     def _GetConfigFilePath(self, useApiIfUnknown:bool = False) -> str:
         # First, try the path where the config will be if we are running on a container.
-        if os.path.exists(ConfigManager.c_ContainerConfigFilePath) and os.path.isfile(ConfigManager.c_ContainerConfigFilePath):
+        containerPath = self._ContainerConfigFilePath
+        if containerPath is not None:
+            return containerPath
+        containerPath = ConfigManager.c_ContainerConfigFilePath
+        if ConfigManager._IsRegularFile(containerPath):
             self.Logger.debug("HA config path found in expected container location.")
-            return ConfigManager.c_ContainerConfigFilePath
+            self._ContainerConfigFilePath = containerPath
+            return containerPath
+
+        # If we already found the path from the API, make sure it's still there.
+        # The path doesn't really change at runtime, so we only check the disk again after the TTL.
+        resolvedPath = self._ResolvedConfigFilePath
+        if resolvedPath is not None:
+            now = time.monotonic()
+            if now - self._ResolvedConfigFilePathCheckedAt < ConfigManager.c_ResolvedConfigFilePathTtlSec:
+                return resolvedPath
+            if ConfigManager._IsRegularFile(resolvedPath):
+                self._ResolvedConfigFilePathCheckedAt = now
+                return resolvedPath
+            self._ResolvedConfigFilePath = None
 
         # Next, try to use the API if we were asked to.
         # We do this before the local path, because we know the server we should be connected to,
         # and if it returns a valid config path it's the correct one. Otherwise, we just look for one on disk.
         if useApiIfUnknown:
-            for _ in range(1):
-                # Home Assistant has an API we can use to try to get the config file path.
-                try:
-                    # Ensure we have an API key.
-                    configApiJson = ServerInfo.GetConfigApi(self.Logger)
-                    if configApiJson is None:
-                        self.Logger.warn("We tried to get the HA config file path from the HA API, but the config api failed.")
-                        break
-
-                    # Try to get the config file path from the API.
-                    configDir = configApiJson.get("config_dir", None)
-                    if configDir is None:
-                        self.Logger.warn("Failed to get the config_dir from the HA config API.")
-                        break
-
-                    # See if the path exists.
-                    configFilePath = os.path.join(configDir, "configuration.yaml")
-                    if os.path.exists(configFilePath) and os.path.isfile(configFilePath):
-                        self.Logger.debug(f"HA config path found in from API and is on the local disk {configFilePath}.")
-                        return configFilePath
-                    self.Logger.warn(f"We got a config file path from the HA config API [{configFilePath}] but it doesn't exist on this device.")
-
-                except Exception as e:
-                    Sentry.Exception("ConfigManager._GetConfigFilePath failed.", e)
+            configFilePath = self._TryGetConfigFilePathFromApi()
+            if configFilePath is not None:
+                return configFilePath
 
         # Finally, see if the default config path exists on disk default Home Assistant Core installs.
         # We do this last, because it could be wrong, there could be a standalone addon running on a device with HA, but connected to a different device.
-        if os.path.exists(ConfigManager.c_HomeAssistantCoreInstallConfigFilePath) and os.path.isfile(ConfigManager.c_HomeAssistantCoreInstallConfigFilePath):
+        # For the same reason, we don't remember this path, so the API is still tried next time.
+        corePath = ConfigManager.c_HomeAssistantCoreInstallConfigFilePath
+        if ConfigManager._IsRegularFile(corePath):
             self.Logger.debug("HA config path found expected core install file path.")
-            return ConfigManager.c_HomeAssistantCoreInstallConfigFilePath
+            return corePath
 
         self.Logger.info("Failed to find a config path on disk or from the API.")
         return None
+
+
+    # Tries to get the config file path from the Home Assistant API.
+    # Returns None if the path can't be found or isn't on this device.
+    def _TryGetConfigFilePathFromApi(self) -> str:
+        try:
+            # Home Assistant has an API we can use to try to get the config file path.
+            configApiJson = self._GetCachedConfigApi()
+            if configApiJson is None:
+                self.Logger.warn("We tried to get the HA config file path from the HA API, but the config api failed.")
+                return None
+
+            # Try to get the config file path from the API.
+            configDir = configApiJson.get("config_dir", None)
+            if configDir is None:
+                self.Logger.warn("Failed to get the config_dir from the HA config API.")
+                return None
+
+            # See if the path exists.
+            configFilePath = os.path.join(configDir, "configuration.yaml")
+            if ConfigManager._IsRegularFile(configFilePath):
+                self.Logger.debug(f"HA config path found in from API and is on the local disk {configFilePath}.")
+                self._ResolvedConfigFilePathCheckedAt = time.monotonic()
+                self._ResolvedConfigFilePath = configFilePath
+                return configFilePath
+            self.Logger.warn(f"We got a config file path from the HA config API [{configFilePath}] but it doesn't exist on this device.")
+        except Exception as e:
+            Sentry.Exception("ConfigManager._TryGetConfigFilePathFromApi failed.", e)
+        return None
+
+
+    # Returns the HA config API result, using the cached result if it's not expired.
+    # Returns None if the API call fails. After a failure, we don't call the API again until the retry time, so callers can't hammer it.
+    def _GetCachedConfigApi(self) -> dict:
+        now = time.monotonic()
+        configApiJson = self._ConfigApiCache
+        if configApiJson is not None and now < self._ConfigApiCacheExpiry:
+            return configApiJson
+        if configApiJson is None and now < self._ConfigApiRetryAfter:
+            return None
+        configApiJson = ServerInfo.GetConfigApi(self.Logger)
+        if configApiJson is not None:
+            self._ConfigApiCacheExpiry = time.monotonic() + ConfigManager.c_ConfigApiCacheTtlSec
+        else:
+            self._ConfigApiRetryAfter = time.monotonic() + ConfigManager.c_ConfigApiFailureRetrySec
+        self._ConfigApiCache = configApiJson
+        return configApiJson
+
+
+    # Returns true if the path exists and is a regular file, using only one stat call.
+    @staticmethod
+    def _IsRegularFile(path:str) -> bool:
+        try:
+            return stat.S_ISREG(os.stat(path).st_mode)
+        except OSError:
+            return False
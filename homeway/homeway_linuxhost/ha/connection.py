@@ -1,7 +1,10 @@
 import time
 import json
+import itertools
 import logging
 import threading
+import concurrent.futures
+from typing import Union
 
 from homeway.sentry import Sentry
 from homeway.websocketimpl import Client
@@ -9,6 +12,13 @@ from homeway.websocketimpl import Client
 from .eventhandler import EventHandler
 from .serverinfo import ServerInfo
 
+# orjson is much faster than the built in json lib, and it parses from and dumps to bytes directly.
+# It's not a required package, since it needs a native lib that isn't available on all platforms, so we fall back to json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # Connects to Home Assistant and manages the connection.
 class Connection:
@@ -16,33 +26,68 @@ class Connection:
     # For debugging, it's too chatty to enable always.
     c_LogWsMessages = False
 
+    # Event messages are sent as {"id":<id>,"type":"event","event":{...}}, so the type will always be in the first few bytes.
+    # We only look for it there, so we don't match on some string inside of another message's data.
+    c_EventTypeToken = b'"type":"event"'
+    c_EventTypeTokenSearchLen = 64
+
+    # The largest message we will accept from HA. Even big homes are well under this, so anything bigger is something wrong,
+    # and we don't want to try to parse it and run out of memory.
+    c_MaxWsMessageSizeBytes = 16 * 1024 * 1024
+
+    # The reconnect backoff is capped at this many seconds, and the counter is capped where the backoff reaches it.
+    c_MaxBackoffSec = 300
+    c_MaxBackoffCounter = 6
+
+    # Prebuilt payloads for the control messages we send on every connect, so they don't need to be dumped each time.
+    # Messages sent after auth need an id, so those have a %d placeholder for it.
+    # SendMsg fills the id in with the % operator, so these must have exactly one %d and no other % characters.
+    c_SubscribeEventsPayload = b'{"type":"subscribe_events","id":%d}'
+    c_RestartHaPayload = b'{"type":"call_service","domain":"homeassistant","service":"restart","service_data":{},"id":%d}'
+    assert c_SubscribeEventsPayload.count(b"%") == 1 and c_SubscribeEventsPayload.count(b"%d") == 1
+    assert c_RestartHaPayload.count(b"%") == 1 and c_RestartHaPayload.count(b"%d") == 1
+
     def __init__(self, logger:logging.Logger, eventHandler:EventHandler) -> None:
         self.Logger = logger
         self.EventHandler = eventHandler
         self.HaVersionString = None
 
+        # The event types the event handler cares about, as raw bytes, so we can skip parsing any other events.
+        self.HandledEventTypeTokens = eventHandler.GetHandledEventTypeTokens()
+
         # The current websocket connection and Id
         self.ConId = 0
+        # The log tag only changes with the connection id, so it's built once per connection.
+        self.LogTag = "HaCon [0]"
         self.BackoffCounter = 0
         self.Ws = None
 
         # We need to send a message id with each message.
-        self.MsgIdLock = threading.Lock()
-        self.MsgId = 1
+        # next() on itertools.count is atomic under the GIL, so this doesn't need a lock.
+        self.MsgIdGen = itertools.count(1)
 
         # Indicates if the connection is connection and authed.
         self.IsConnected = False
 
+        # The auth message payload, built from the access token when we first connect.
+        # It's kept across reconnects and only built again if HA rejects it.
+        self.AuthPayload:bytes = None
+
         # If set, when the websocket is connected, we should send the HA restart command.
         self.IssueRestartOnConnect = False
 
-        # Allows for blocking message send responses.
-        self.PendingContextsLock = threading.Lock()
+        # Allows for blocking message send responses, this maps the message id to the future waiting on the response.
+        # This doesn't need a lock, since we only ever do single set and pop operations, which are atomic under the GIL.
         self.PendingContexts = {}
 
         # If set, we call this back when the WS is connected and authed.
         self.HomeContextOnConnectedCallback = None
 
+        # The websocket callbacks never change, so bind them once rather than on every reconnect.
+        self.BoundOnWsOpened = self._OnWsOpened
+        self.BoundOnWsData = self._OnData
+        self.BoundOnWsClosed = self._OnWsClosed
+
 
     def Start(self) -> None:
         t = threading.Thread(target=self.ConnectionThread)
@@ -54,10 +99,10 @@ class Connection:
     def RestartHa(self) -> None:
         if self.IsConnected:
             self.IssueRestartOnConnect = False
-            self.Logger.error(f"{self._getLogTag()} Sending HA restart command.")
-            self.SendMsg({"type": "call_service", "domain": "homeassistant", "service": "restart", "service_data": {}})
+            self.Logger.error("%s Sending HA restart command.", self._getLogTag())
+            self.SendMsg(Connection.c_RestartHaPayload)
         else:
-            self.Logger.error(f"{self._getLogTag()} HA restart command deferred, since we aren't connected.")
+            self.Logger.error("%s HA restart command deferred, since we aren't connected.", self._getLogTag())
             self.IssueRestartOnConnect = True
 
 
@@ -68,7 +113,7 @@ class Connection:
 
     # Called when the websocket is up and authed.
     def _OnConnected(self) -> None:
-        self.Logger.info(f"{self._getLogTag()} Successfully authed and connected!")
+        self.Logger.info("%s Successfully authed and connected!", self._getLogTag())
 
         # If we need to restart HA, do it now.
         if self.IssueRestartOnConnect:
@@ -79,8 +124,8 @@ class Connection:
         # We need to subscribe to events, so we can fire the required assistant callbacks.
         # TODO - For now this subs us to everything. We can also be selective of which types we want, which we could
         # explore in the future.
-        if self.SendMsg({"type":"subscribe_events"}) is False:
-            self.Logger.error(f"{self._getLogTag()} failed to send event subscribe call.")
+        if self.SendMsg(Connection.c_SubscribeEventsPayload) is False:
+            self.Logger.error("%s failed to send event subscribe call.", self._getLogTag())
 
         # If we have a callback, call it.
         callback = self.HomeContextOnConnectedCallback
@@ -95,42 +140,38 @@ class Connection:
             # Reset the state vars
             self.IsConnected = False
             self.Ws = None
-            self.MsgId = 1
+            self.MsgIdGen = itertools.count(1)
+
+            # Any responses we were waiting on won't come now, so wake up the senders rather than letting them wait out the timeout.
+            self._CancelPendingContexts()
 
             # If this isn't the first connection, sleep a bit before trying again.
             if self.ConId != 0:
-                self.BackoffCounter += 1
-                self.BackoffCounter = min(self.BackoffCounter, 12)
-                self.Logger.error(f"{self._getLogTag()} sleeping before trying the HA connection again.")
-                time.sleep(5 * self.BackoffCounter)
+                # Back off exponentially, 10s, 20s, 40s... up to the max, so we don't hammer HA while it's down.
+                self.BackoffCounter = min(self.BackoffCounter + 1, Connection.c_MaxBackoffCounter)
+                self.Logger.error("%s sleeping before trying the HA connection again.", self._getLogTag())
+                time.sleep(min(5 << self.BackoffCounter, Connection.c_MaxBackoffSec))
             self.ConId += 1
+            self.LogTag = f"HaCon [{self.ConId}]"
 
             try:
                 # First, we need to get the access token. If we are running in the addon, we should be able to pull it from the env var,
                 # since we use the flag in our addon config.
-                accessToken = ServerInfo.GetAccessToken()
-                if accessToken is None or len(accessToken) == 0:
-                    # We need an access token, so we can't do anything.
-                    self.Logger.error(f"{self._getLogTag()} no access token, thus we can't connect.")
-                    time.sleep(120)
-                    continue
+                if self.AuthPayload is None:
+                    accessToken = ServerInfo.GetAccessToken()
+                    if accessToken is None or len(accessToken) == 0:
+                        # We need an access token, so we can't do anything.
+                        self.Logger.error("%s no access token, thus we can't connect.", self._getLogTag())
+                        time.sleep(120)
+                        continue
+                    self.AuthPayload = Connection._BuildAuthPayload(accessToken)
 
                 # If we are here, we have an access token!
-                # Setup our handlers.
-
-                # This is called when the socket is opened.
-                def Opened(ws:Client):
-                    self.Logger.info(f"{self._getLogTag()} Websocket opened")
-
-                # Called when the websocket is closed.
-                def Closed(ws:Client):
-                    self.Logger.info(f"{self._getLogTag()} Websocket closed")
-
                 # Start the web socket connection.
                 # If we got auth from the env var, we running in the add on and use this address.
                 uri = f"{(ServerInfo.GetServerBaseUrl('ws'))}/api/websocket"
-                self.Logger.info(f"{self._getLogTag()} Starting connection to [{uri}]")
-                self.Ws = Client(uri, onWsOpen=Opened, onWsData=self._OnData, onWsClose=Closed)
+                self.Logger.info("%s Starting connection to [%s]", self._getLogTag(), uri)
+                self.Ws = Client(uri, onWsOpen=self.BoundOnWsOpened, onWsData=self.BoundOnWsData, onWsClose=self.BoundOnWsClosed)
 
                 # It's important that we disable cert checks since the server might have a self signed cert or cert for a hostname that we aren't using.
                 # This is safe to do, since the connection will be localhost or on the local LAN
@@ -139,76 +180,111 @@ class Connection:
                 # Run until success or failure.
                 self.Ws.RunUntilClosed()
 
-                self.Logger.info(f"{self._getLogTag()} Loop restarting.")
+                self.Logger.info("%s Loop restarting.", self._getLogTag())
 
             except Exception as e:
                 Sentry.Exception("ConnectionThread exception.", e)
 
 
+    # This is called when the socket is opened.
+    def _OnWsOpened(self, ws:Client):
+        self.Logger.info("%s Websocket opened", self._getLogTag())
+
+
+    # Called when the websocket is closed.
+    def _OnWsClosed(self, ws:Client):
+        self.Logger.info("%s Websocket closed", self._getLogTag())
+
+
     def _OnData(self, ws:Client, buffer:bytes, msgType):
         try:
-            jsonStr = buffer.decode()
-            jsonObj = json.loads(jsonStr)
+            # Make sure the message isn't too big to handle, before we do anything with it.
+            if len(buffer) > Connection.c_MaxWsMessageSizeBytes:
+                self.Logger.error("%s HA sent a message that's too large to handle, %s bytes. Closing the connection.", self._getLogTag(), len(buffer))
+                self.Close()
+                return
+
+            # Most of the messages HA sends are events, and most of those are types we will just ignore.
+            # So before we parse the message, do a quick check on the raw bytes, and skip the message if it's an event we don't handle.
+            if self.IsConnected and buffer.find(Connection.c_EventTypeToken, 0, Connection.c_EventTypeTokenSearchLen) != -1:
+                isHandledEvent = False
+                for token in self.HandledEventTypeTokens:
+                    if buffer.find(token) != -1:
+                        isHandledEvent = True
+                        break
+                if isHandledEvent is False:
+                    return
+
+            # Both libs can parse the bytes directly, so we don't need to decode them into a string first.
+            if orjson is not None:
+                jsonObj = orjson.loads(buffer)
+            else:
+                jsonObj = json.loads(buffer)
             if self.Logger.isEnabledFor(logging.DEBUG) and Connection.c_LogWsMessages:
-                jsonFormatted = json.dumps(jsonObj, indent=2)
-                self.Logger.debug(f"{self._getLogTag()} WS Message \r\n{jsonFormatted}\r\n")
+                # Log the raw message, rather than dumping the parsed object again.
+                self.Logger.debug("%s WS Message \r\n%s\r\n", self._getLogTag(), buffer.decode(errors='replace'))
+
+            # Get the type once, since we check it a few times.
+            msgType = jsonObj.get("type", None)
 
             # Before we do anything, make sure we are authed.
             if self.IsConnected is False:
                 # Check if this is the auth response.
-                if "type" in jsonObj and jsonObj["type"] == "auth_ok":
+                if msgType == "auth_ok":
                     # Auth success!
                     self.IsConnected = True
                     self.BackoffCounter = 0
                     self._OnConnected()
                     return
                 # Check for an auth failed response.
-                if "type" in jsonObj and jsonObj["type"] == "auth_invalid":
-                    msg = "unknown"
-                    if "message" in jsonObj:
-                        msg = jsonObj["message"]
-                    self.Logger.error(f"{self._getLogTag()} Auth failed! Message: {msg}")
+                if msgType == "auth_invalid":
+                    msg = jsonObj.get("message", "unknown")
+                    self.Logger.error("%s Auth failed! Message: %s", self._getLogTag(), msg)
+                    # Get the access token again on the next connect, in case it changed.
+                    self.AuthPayload = None
                     # Home assistant will close the ws, but we will do it as well.
                     self.Close()
                     return
 
                 # Otherwise, this should be very first message, which is the auth require message.
                 # The version should be in the auth_required message, if so, print it.
-                if "ha_version" in jsonObj:
-                    self.HaVersionString = jsonObj["ha_version"]
-                    self.Logger.info(f"{self._getLogTag()} HA version {(self.HaVersionString)}")
-                if "type" not in jsonObj or jsonObj["type"] != "auth_required":
-                    self.Logger.warn(f"{self._getLogTag()} we aren't authed, we are expecting auth_required but didn't get it.")
+                haVersion = jsonObj.get("ha_version", None)
+                if haVersion is not None:
+                    self.HaVersionString = haVersion
+                    self.Logger.info("%s HA version %s", self._getLogTag(), self.HaVersionString)
+                if msgType != "auth_required":
+                    self.Logger.warn("%s we aren't authed, we are expecting auth_required but didn't get it.", self._getLogTag())
                 # Return the auth message
                 # https://developers.home-assistant.io/docs/api/websocket/
-                self.SendMsg({"type":"auth", "access_token": ServerInfo.GetAccessToken()}, ignoreConnectionState=True)
+                authPayload = self.AuthPayload
+                if authPayload is None:
+                    authPayload = Connection._BuildAuthPayload(ServerInfo.GetAccessToken())
+                self.SendMsg(authPayload, ignoreConnectionState=True)
                 return
 
             # For now, if there are any errors, we always log them.
-            if "success" in jsonObj and jsonObj["success"] is not True:
-                self.Logger.error(f"{self._getLogTag()} HA returned an error. {jsonStr}")
+            success = jsonObj.get("success", None)
+            if success is not None and success is not True:
+                self.Logger.error("%s HA returned an error. %s", self._getLogTag(), buffer.decode(errors='replace'))
 
-            msgType = jsonObj.get("type", None)
             if msgType is None:
-                self.Logger.error(f"{self._getLogTag()} message without a type field! {json.dumps(jsonObj, indent=2)}")
+                self.Logger.error("%s message without a type field! %s", self._getLogTag(), json.dumps(jsonObj, indent=2))
                 return
 
             if msgType == "result":
                 # Check if there's a pending context for this message ID.
                 msgId = jsonObj.get("id", None)
                 if msgId is None:
-                    self.Logger.error(f"{self._getLogTag()} result message without an id field!")
+                    self.Logger.error("%s result message without an id field!", self._getLogTag())
                 else:
                     # Check if there's a pending context for this message.
                     # It's ok if there's no pending context, since we might have sent a message that we don't care about the response.
-                    with self.PendingContextsLock:
-                        if msgId in self.PendingContexts:
-                            # If we find a mach, set the response and signal the event.
-                            pendingContext = self.PendingContexts[msgId]
-                            pendingContext.Response = jsonObj
-                            pendingContext.Event.set()
-                            # Return since this message is being handled by the pending context.
-                            return
+                    pendingContext = self.PendingContexts.pop(msgId, None)
+                    if pendingContext is not None:
+                        # If we find a mach, set the response, which wakes up the sender.
+                        pendingContext.set_result(jsonObj)
+                        # Return since this message is being handled by the pending context.
+                        return
 
             # Finally, if the message is a event, invoke the handler.
             elif msgType == "event":
@@ -226,66 +302,91 @@ class Connection:
     # Sends a message to Home Assistant.
     # If waitForResponse is True, either the response dict will be returned or False if the message failed or timeout.
     # If waitForResponse is False, True will be returned if the message was sent, False if it failed.
-    def SendMsg(self, msg:dict, waitForResponse:bool = False, ignoreConnectionState:bool = False) -> bool:
+    # The message can either be a dict, which will have the id added and be dumped to json, or prebuilt json bytes.
+    # Prebuilt bytes sent after auth are formatted with the % operator to add the id, so they must have exactly one %d placeholder for the id and no other % characters.
+    # Prebuilt bytes sent before auth are sent as is.
+    def SendMsg(self, msg:Union[dict, bytes], waitForResponse:bool = False, ignoreConnectionState:bool = False) -> bool:
         # Check the connection state.
         if ignoreConnectionState is False:
             if self.IsConnected is False:
-                self.Logger.error(f"{self._getLogTag()} message tired to be sent while we weren't authed.")
+                self.Logger.error("%s message tired to be sent while we weren't authed.", self._getLogTag())
                 return False
         # Capture and check the websocket.
         ws = self.Ws
         if ws is None:
-            self.Logger.error(f"{self._getLogTag()} message tired to be sent while we weren't connected.")
+            self.Logger.error("%s message tired to be sent while we weren't connected.", self._getLogTag())
             return False
 
         msgId = 0
         pendingContext = None
         try:
             # Add the id field to all messages that are post auth.
+            isPrebuilt = isinstance(msg, bytes)
             if self.IsConnected:
-                with self.MsgIdLock:
-                    msgId = self.MsgId
+                msgId = next(self.MsgIdGen)
+                if isPrebuilt is False:
                     msg["id"] = msgId
-                    self.MsgId += 1
 
             # Create a pending context
             if waitForResponse:
-                pendingContext = PendingContexts()
-                with self.PendingContextsLock:
-                    self.PendingContexts[msgId] = pendingContext
-
-            # Dump the message
-            jsonStr = json.dumps(msg)
+                pendingContext = concurrent.futures.Future()
+                self.PendingContexts[msgId] = pendingContext
+
+            # Dump the message, orjson gives us the bytes directly, so we only need to encode when using the json lib.
+            if isPrebuilt:
+                payload = msg % msgId if msgId != 0 else msg
+            elif orjson is not None:
+                payload = orjson.dumps(msg, option=orjson.OPT_NON_STR_KEYS)
+            else:
+                # Match orjson's compact output, so we don't send the extra whitespace.
+                payload = json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
             if self.Logger.isEnabledFor(logging.DEBUG) and Connection.c_LogWsMessages:
-                self.Logger.debug(f"{self._getLogTag()} Sending Ws Message {jsonStr}")
+                self.Logger.debug("%s Sending Ws Message %s", self._getLogTag(), payload.decode())
 
-            # Since we must encode the data, which will create a copy, we might as well just send the buffer as normal,
-            # without adding the extra space for the header. We can add the header here or in the WS lib, it's the same amount of work.
-            ws.Send(jsonStr.encode(), isData=False)
+            # We send the buffer as normal, without adding the extra space for the header.
+            # We can add the header here or in the WS lib, it's the same amount of work.
+            ws.Send(payload, isData=False)
 
             # If we aren't waiting for a response, we are done.
             if pendingContext is None:
                 return True
 
-            # Wait for the response.
-            if pendingContext.Event.wait(10.0) is False:
-                # Timeout, return false.
-                return False
-
-            # We got the response, return it.
-            return pendingContext.Response
-
-            # Wait for the response.
+            # Wait for the response, and return it when we get it.
+            return pendingContext.result(timeout=10.0)
+        except concurrent.futures.TimeoutError:
+            # Timeout, return false.
+            return False
+        except concurrent.futures.CancelledError:
+            # The connection closed before we got the response.
+            return False
         except Exception as e:
             Sentry.Exception("SendMsg exception.", e)
         finally:
             # If we have a pending context, make sure to remove it.
+            # If the response came in, the reader already removed it.
             if pendingContext is not None:
-                with self.PendingContextsLock:
-                    del self.PendingContexts[msgId]
+                self.PendingContexts.pop(msgId, None)
         return False
 
 
+    # Cancels all of the pending contexts, which wakes up any senders waiting on them.
+    def _CancelPendingContexts(self) -> None:
+        # popitem is atomic, so this is safe to do while other threads are adding or removing contexts.
+        while True:
+            try:
+                _, pendingContext = self.PendingContexts.popitem()
+            except KeyError:
+                return
+            pendingContext.cancel()
+
+
+    # Builds the auth message payload for the given access token.
+    # The token is the only dynamic part, so it's the only part that needs to be dumped.
+    @staticmethod
+    def _BuildAuthPayload(accessToken:str) -> bytes:
+        return b'{"type":"auth","access_token":' + json.dumps(accessToken).encode("utf-8") + b'}'
+
+
     # Closes the connection if it's open.
     def Close(self) -> None:
         ws = self.Ws
@@ -294,12 +395,4 @@ class Connection:
 
 
     def _getLogTag(self) -> str:
-        return f"HaCon [{self.ConId}]"
-
-
-# Holds a pending context for an outstanding sent message.
-class PendingContexts:
-
-    def __init__(self):
-        self.Event = threading.Event()
-        self.Response:dict = None
+        return self.LogTag
@@ -1,14 +1,24 @@
 import ssl
 import time
 import json
+import queue
 import logging
 import threading
+import collections
+import requests
 
 from homeway.sentry import Sentry
 from homeway.httpsessions import HttpSessions
 
 from .serverinfo import ServerInfo
 
+# orjson is much faster than the built in json lib, and it dumps to bytes directly.
+# It's not a required package, since it needs a native lib that isn't available on all platforms, so we fall back to json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Handles any events from Home Assistant we care about.
 class EventHandler:
 
@@ -33,37 +43,93 @@ class EventHandler:
     # The number of updates between allowed throttled updates.
     c_SpammyEntityUpdateAllowFrequency = 30
 
+    # The max number of events that can be waiting to be sent. If we can't send, this keeps the pending events from growing forever.
+    # Updates for an entity that already has a pending update still replace it when this is full, so only new entities, adds, removes, and renames are dropped.
+    c_MaxPendingEvents = 2000
+
+    # The entity id of the event we send once we get the API key, to make sure the server is in sync.
+    c_StartupSyncEntityId = "startup_sync"
+
+    # The connect and read timeouts for sending events. These are kept short so a slow server doesn't hold up the following batches.
+    c_SendConnectTimeoutSec = 5.0
+    c_SendReadTimeoutSec = 15.0
+
+    # How often we check the HA temp units, and how long after startup we do the first check.
+    c_TempUnitsCheckIntervalSec = 60.0 * 60
+    c_TempUnitsFirstCheckDelaySec = 2.0
+
     # Useful for debugging.
     c_LogEvents = False
 
+    # Used to tell a missing field apart from a field that's set to null.
+    c_MissingField = object()
+
+    # The event types OnEvent handles, all other events are ignored.
+    # The HA connection uses this to skip parsing event messages that would just be ignored.
+    c_HandledEventTypes = ("state_changed",)
+
+    # For state changes, we only care about a subset of devices. Some types are way to verbose to report.
+    # A full list of entity can be found here: https://developers.home-assistant.io/docs/core/entity/
+    # These are the entity domains, which is the part of the entity id before the first dot.
+    c_StateChangeEntityDomains = frozenset((
+        "light",
+        "switch",
+        "input_boolean",
+        "scene",
+        "cover",
+        "fan",
+        "lock",
+        "alarm_control_panel",
+        "climate",
+    ))
+
+    # The state fields we don't need to send, they are removed to keep the size down.
+    c_StateTrimKeys = frozenset(("entity_id", "context", "last_changed", "last_updated"))
+
     def __init__(self, logger:logging.Logger, pluginId:str, devLocalHomewayServerAddress_CanBeNone:str) -> None:
         self.Logger = logger
         self.PluginId = pluginId
         self.HomewayApiKey = ""
         self.DevLocalHomewayServerAddress_CanBeNone = devLocalHomewayServerAddress_CanBeNone
 
+        # The url we send the state change events to, this doesn't change so it's built once.
+        self.StateChangeEventsUrl = "https://homeway.io/api/plugin-api/statechangeevents"
+        if devLocalHomewayServerAddress_CanBeNone is not None:
+            self.StateChangeEventsUrl = f"http://{devLocalHomewayServerAddress_CanBeNone}/api/plugin-api/statechangeevents"
+
         # Request collapse logic.
-        self.ThreadEvent = threading.Event()
-        self.Lock = threading.Lock()
-        self.SendEvents = []
-        self.SpammyEntityDict = {}
-        self.SendPeriodStartSec = 0.0
+        # The queue hands the events off to the send thread.
+        # SimpleQueue is implemented in C and doesn't need a python level lock to put.
+        # It's unbounded, but the send thread always drains it into PendingEvents, which is bounded.
+        self.SendQueue = queue.SimpleQueue()
+        # The spammy entity tracking has its own lock, which is only held for the count bookkeeping.
+        self.SpammyLock = threading.Lock()
+        self.SpammyEntityDict = collections.defaultdict(int)
+        # The monotonic clock has an arbitrary start point, so start the period outside of the window so the first send is quick.
+        self.SendPeriodStartSec = time.monotonic() - EventHandler.c_SendPeriodWindowSec
         self.SentCountThisPeriod = 0
-        self.SpammyEntityWindowStartSec = 0.0
+        self.SpammyEntityWindowStartSec = time.monotonic()
 
-        # Start the send thread.
-        self.Thread = threading.Thread(target=self._StateChangeSender)
-        self.Thread.daemon = True
-        self.Thread.start()
+        # The events the send thread has taken from the queue but hasn't sent yet, in the order they happened.
+        # For each entity with a pending update that can be collapsed, the index of that update in PendingEvents.
+        # These are only used by the send thread.
+        self.PendingEvents = []
+        self.PendingUpdateIndexByEntity = {}
 
-        # We need to detect the temp units.
-        self.TempThread = threading.Thread(target=self._TempUnitsDetector)
-        self.TempThread.daemon = True
-        self.TempThread.start()
+        # Set when the startup_sync event is queued, so the send thread sends it right away.
+        self.StartupSyncPending = False
 
         # Must be C or F, default to C
         self.HaTempUnits = "C"
 
+        # We need to detect the temp units, which is done by the send thread when it's idle.
+        self.NextTempUnitsCheckSec = time.monotonic() + EventHandler.c_TempUnitsFirstCheckDelaySec
+
+        # Start the send thread.
+        self.Thread = threading.Thread(target=self._StateChangeSender)
+        self.Thread.daemon = True
+        self.Thread.start()
+
         # A callback to fire if the home context needs to be updated.
         self.HomeContextCallback = None
 
@@ -73,11 +139,20 @@ class EventHandler:
         hadKey = self.HomewayApiKey is not None and len(self.HomewayApiKey) > 0
         self.HomewayApiKey = key
         if hadKey is False:
-            entityId = "startup_sync"
+            entityId = EventHandler.c_StartupSyncEntityId
             e = self._GetStateChangeSendEventAndValidate(entityId)
             if e is None:
                 self.Logger.error("startup_sync event failed to generate a send payload.")
-            self._QueueStateChangeSend(entityId, e)
+                return
+            # This skips the spammy entity tracking, since it's only sent once.
+            # The send thread will send it without waiting for the collapse delay.
+            self.StartupSyncPending = True
+            self.SendQueue.put((e, False))
+
+
+    # Returns the handled event types as the quoted json string bytes they will appear as in a raw event message.
+    def GetHandledEventTypeTokens(self) -> list:
+        return [f"\"{t}\"".encode("utf-8") for t in EventHandler.c_HandledEventTypes]
 
 
     # Called by the HA connection class when HA sends a new state.
@@ -88,14 +163,10 @@ class EventHandler:
     # Called by the HA connection class when HA sends any event.
     def OnEvent(self, event:dict, haVersion:str) -> None:
 
-        # Check for required fields
-        if "event_type" not in event:
-            self.Logger.warn("Event Handler got an event that was missing the event_type.")
-            return
-        eventType = event["event_type"]
-
         # Right now, we only need to look at state changed events.
-        if eventType != "state_changed":
+        # If this changes, c_HandledEventTypes must be updated as well.
+        # A missing event_type will be None, which is also ignored.
+        if event.get("event_type") != "state_changed":
             return
 
         # Log if needed.
@@ -104,13 +175,17 @@ class EventHandler:
 
         # Get the common data.
         # Note that these will still be in data, but can be set to null.
-        if "data" not in event or "old_state" not in event["data"] or "new_state" not in event["data"] or "entity_id" not in event["data"]:
-            self.Logger.warn("Event Handler got an event that was missing the data/old_state/new_state/entity_id fields.")
+        # Since the states can be null, we use a sentinel to tell if they are missing.
+        data = event.get("data")
+        if data is None:
+            self.Logger.warn("Event Handler got an event that was missing the data field.")
+            return
+        entityId = data.get("entity_id")
+        newState_CanBeNone = data.get("new_state", EventHandler.c_MissingField)
+        oldState_CanBeNone = data.get("old_state", EventHandler.c_MissingField)
+        if entityId is None or newState_CanBeNone is EventHandler.c_MissingField or oldState_CanBeNone is EventHandler.c_MissingField:
+            self.Logger.warn("Event Handler got an event that was missing the old_state/new_state/entity_id fields.")
             return
-
-        entityId = event["data"]["entity_id"]
-        newState_CanBeNone = event["data"]["new_state"]
-        oldState_CanBeNone = event["data"]["old_state"]
         # We can combine report state and request sync for assistants into a single API.
         # When a device is added...
         #    state_changed is fired with a null old_state and a new_state with the device info.
@@ -137,30 +212,26 @@ class EventHandler:
 
         # If this is just a state change, see if we care about it.
         if isAddRemoveOrNameChange is False:
-            # For state changes, we only care about a subset of devices. Some types are way to verbose to report.
-            # A full list of entity can be found here: https://developers.home-assistant.io/docs/core/entity/
-            if (    entityId.startswith("light.")  is False
-                and entityId.startswith("switch.") is False
-                and entityId.startswith("input_boolean.") is False
-                and entityId.startswith("scene.") is False
-                and entityId.startswith("cover.")  is False
-                and entityId.startswith("fan.")    is False
-                and entityId.startswith("lock.")   is False
-                and entityId.startswith("alarm_control_panel.")   is False
-                and entityId.startswith("climate.")is False):
-                    # If we are here...
-                    #    This is not a entity we always sent.
-                    #    There is a new state and old state
-                    #    There's NO friendly name change.
-                    # So we ignore it.
+            # For state changes, we only care about a subset of devices, see c_StateChangeEntityDomains.
+            if entityId.partition(".")[0] not in EventHandler.c_StateChangeEntityDomains:
+                # If we are here...
+                #    This is not a entity we always sent.
+                #    There is a new state and old state
+                #    There's NO friendly name change.
+                # So we ignore it.
                 return
 
         # If we get here, this is an status change we want to send.
+        # Check if the entity is being throttled first, so we don't build the send event just to drop it.
+        if self._ShouldAcceptForSend(entityId) is False:
+            return
+
         # Build the dict we will send and validate that everything we need to send is there.
         e = self._GetStateChangeSendEventAndValidate(entityId, haVersion, newState_CanBeNone, oldState_CanBeNone)
         if e is None:
             return
-        self._QueueStateChangeSend(entityId, e)
+        # Adds, removes, and renames can't be collapsed with other updates for the entity, or the server would miss them.
+        self._QueueStateChangeSend(entityId, e, isAddRemoveOrNameChange is False)
 
 
     # Converts the HA events to our send event format.
@@ -171,179 +242,228 @@ class EventHandler:
         if haVersion_CanBeNone is not None:
             sendEvent["HaVersion"] = haVersion_CanBeNone
 
-        # Helpers
-        def _removeIfInDict(d:dict, key:str):
-            # Removes a key from the dict if it's there.
-            if key in d:
-                del d[key]
-        def _trimState(state:dict):
-            # Remove any bloat we don't need, to keep the size down.
-            _removeIfInDict(state, "entity_id")
-            _removeIfInDict(state, "context")
-            _removeIfInDict(state, "last_changed")
-            _removeIfInDict(state, "last_updated")
-        def _validateHasRequiredFields(d:dict) -> bool:
-            # Sometimes during startup we get messages without friendly names.
-            # We need the friendly names to talk with both Alexa and Google, so we just ignore them.
-            # The updates are usually for offline devices anyways, maybe that's why they don't have names?
-            a = d.get("attributes", None)
-            if a is None:
-                return False
-            name = a.get("friendly_name", None)
-            if name is None or len(name) == 0:
-                return False
-            return True
         # If there's a new state, add it.
         if newState_CanBeNone is not None:
-            if _validateHasRequiredFields(newState_CanBeNone) is False:
+            if EventHandler._ValidateHasRequiredFields(newState_CanBeNone) is False:
                 return None
-            _trimState(newState_CanBeNone)
+            newState = EventHandler._GetTrimmedState(newState_CanBeNone)
             # We add the temp units we detect, so our servers know.
-            newState_CanBeNone["HwTempUnits"] = self.HaTempUnits
-            sendEvent["NewState"] = newState_CanBeNone
+            newState["HwTempUnits"] = self.HaTempUnits
+            sendEvent["NewState"] = newState
         # If there's a old state, add it.
         if oldState_CanBeNone is not None:
-            if _validateHasRequiredFields(oldState_CanBeNone) is False:
+            if EventHandler._ValidateHasRequiredFields(oldState_CanBeNone) is False:
                 return None
-            _trimState(oldState_CanBeNone)
-            sendEvent["OldState"] = oldState_CanBeNone
+            sendEvent["OldState"] = EventHandler._GetTrimmedState(oldState_CanBeNone)
         return sendEvent
 
 
-    def _QueueStateChangeSend(self, entityId:str, sendEvent:dict):
-        # We collapse individual calls in to a single batch call based on a time threshold.
-        self.Logger.debug(f"_QueueStateChangeSend called `{entityId}`")
-        with self.Lock:
-            # Some individual entities seem to be really spammy, we have seen some lights
-            # that send updates very often. To mitigate that, we will keep track of how many times
-            # each entity reports updates and start limiting them if it's really chatty.
-            # This works by keeping track of each entity and the number of times it's updating.
-            # If it updates more than x times in a time window, the updates will be throttled.
-
+    # Returns a copy of the state without any bloat we don't need, to keep the size down.
+    # The state dict passed in isn't changed.
+    @staticmethod
+    def _GetTrimmedState(state:dict) -> dict:
+        trimKeys = EventHandler.c_StateTrimKeys
+        return {k: v for k, v in state.items() if k not in trimKeys}
+
+
+    # Sometimes during startup we get messages without friendly names.
+    # We need the friendly names to talk with both Alexa and Google, so we just ignore them.
+    # The updates are usually for offline devices anyways, maybe that's why they don't have names?
+    @staticmethod
+    def _ValidateHasRequiredFields(d:dict) -> bool:
+        a = d.get("attributes", None)
+        if a is None:
+            return False
+        name = a.get("friendly_name", None)
+        if name is None or len(name) == 0:
+            return False
+        return True
+
+
+    # Returns False if the entity is being throttled and this update should be dropped.
+    def _ShouldAcceptForSend(self, entityId:str) -> bool:
+        # Some individual entities seem to be really spammy, we have seen some lights
+        # that send updates very often. To mitigate that, we will keep track of how many times
+        # each entity reports updates and start limiting them if it's really chatty.
+        # This works by keeping track of each entity and the number of times it's updating.
+        # If it updates more than x times in a time window, the updates will be throttled.
+        now = time.monotonic()
+        limitBeforeThrottle = EventHandler.c_SpammyEntityUpdateLimitBeforeThrottle
+        with self.SpammyLock:
             # Check if it's time to reset the spammy event dict.
-            if time.time() - self.SpammyEntityWindowStartSec > EventHandler.c_SpammyEntityResetWindowSec:
+            if now - self.SpammyEntityWindowStartSec > EventHandler.c_SpammyEntityResetWindowSec:
                 self.Logger.debug("Event Handler resetting the spammy entity window.")
-                self.SpammyEntityWindowStartSec = time.time()
-                self.SpammyEntityDict = {}
+                self.SpammyEntityWindowStartSec = now
+                self.SpammyEntityDict.clear()
 
             # Handle updating the count for this entity
-            if entityId in self.SpammyEntityDict:
-                updateCount = self.SpammyEntityDict[entityId] + 1
-                self.SpammyEntityDict[entityId] = updateCount
-                # Check this entity is over the limit
-                if updateCount >= EventHandler.c_SpammyEntityUpdateLimitBeforeThrottle:
-                    if updateCount == EventHandler.c_SpammyEntityUpdateLimitBeforeThrottle:
-                        self.Logger.debug(f"Entity {entityId} just hit the spam limit and will now be throttled.")
-                    # The entity is over the limit, check if we should allow this one through.
-                    if updateCount % EventHandler.c_SpammyEntityUpdateAllowFrequency != 0:
-                        # Drop this update.
-                        return
-                    self.Logger.debug(f"Allowing a throttled event for {entityId}. Total updates: {updateCount}")
-            else:
-                self.SpammyEntityDict[entityId] = 1
+            updateCount = self.SpammyEntityDict[entityId] + 1
+            self.SpammyEntityDict[entityId] = updateCount
+
+        # Check this entity is over the limit, this doesn't need the lock since we have our count.
+        if updateCount >= limitBeforeThrottle:
+            if updateCount == limitBeforeThrottle:
+                self.Logger.debug("Entity %s just hit the spam limit and will now be throttled.", entityId)
+            # The entity is over the limit, check if we should allow this one through.
+            if updateCount % EventHandler.c_SpammyEntityUpdateAllowFrequency != 0:
+                # Drop this update.
+                return False
+            self.Logger.debug("Allowing a throttled event for %s. Total updates: %d", entityId, updateCount)
+        return True
 
-            # Add this event to the queue.
-            self.SendEvents.append(sendEvent)
-            # Set the event to wake up the thread, if it's not already.
-            self.ThreadEvent.set()
+
+    # canCollapse should be True if this event is just a state update, so it can be replaced by a newer update for the same entity.
+    def _QueueStateChangeSend(self, entityId:str, sendEvent:dict, canCollapse:bool):
+        # We collapse individual calls in to a single batch call based on a time threshold.
+        self.Logger.debug("_QueueStateChangeSend called `%s`", entityId)
+
+        # Add this event to the queue, which will wake up the send thread if it's waiting.
+        self.SendQueue.put((sendEvent, canCollapse))
+
+
+    # Adds an event taken from the send queue to the pending events. This is only called by the send thread.
+    def _AddPendingEvent(self, queueItem:tuple) -> None:
+        sendEvent, canCollapse = queueItem
+        entityId = sendEvent["EntityId"]
+        if canCollapse:
+            # Only the newest state for each entity matters, so if there's already a pending update for this entity, replace it.
+            # The newer update takes the place of the old one, so the event order is kept.
+            index = self.PendingUpdateIndexByEntity.get(entityId)
+            if index is not None:
+                self.PendingEvents[index] = sendEvent
+                return
+        # If we can't replace a pending event, make sure there's room for this one.
+        # The startup_sync is only sent once and is always kept, since it makes sure the server is in sync.
+        if len(self.PendingEvents) >= EventHandler.c_MaxPendingEvents and entityId != EventHandler.c_StartupSyncEntityId:
+            self.Logger.warn("The pending state change events are full, dropping the event for %s.", entityId)
+            return
+        if canCollapse:
+            self.PendingUpdateIndexByEntity[entityId] = len(self.PendingEvents)
+        else:
+            # Adds, removes, renames, and the startup_sync are never collapsed.
+            # Any update after this one must be sent after it, so it can't replace an update from before it.
+            self.PendingUpdateIndexByEntity.pop(entityId, None)
+        self.PendingEvents.append(sendEvent)
+
+
+    # Takes events from the send queue and adds them to the pending events until the time is up. This is only called by the send thread.
+    def _CollectPendingEvents(self, durationSec:float) -> None:
+        deadline = time.monotonic() + durationSec
+        while True:
+            remainingSec = deadline - time.monotonic()
+            if remainingSec <= 0:
+                return
+            try:
+                self._AddPendingEvent(self.SendQueue.get(timeout=remainingSec))
+            except queue.Empty:
+                return
 
 
     def _StateChangeSender(self):
         while True:
             try:
-                # Always check if there's something to send. If not, we sleep.
-                hasEventsToSend = False
-                with self.Lock:
-                    if len(self.SendEvents) > 0:
-                        hasEventsToSend = True
-                    else:
-                        # Make sure all pending events are cleared.
-                        self.ThreadEvent.clear()
-
-                # If there's nothing to send, we sleep.
-                if hasEventsToSend is False:
-                    self.ThreadEvent.wait()
-                    continue
+                # If there's nothing to send, block until there is.
+                if len(self.PendingEvents) == 0:
+                    # While we are idle, check the temp units if it's time to.
+                    if time.monotonic() >= self.NextTempUnitsCheckSec:
+                        self._DetectTempUnits()
+                        self.NextTempUnitsCheckSec = time.monotonic() + EventHandler.c_TempUnitsCheckIntervalSec
+                    try:
+                        self._AddPendingEvent(self.SendQueue.get(timeout=max(self.NextTempUnitsCheckSec - time.monotonic(), 0.0)))
+                    except queue.Empty:
+                        continue
 
                 # If we get here, we have something to send.
                 # To allow a quick one off response, we will wait a shorter amount of time for the first send in a new period.
                 # To prevent spamming, every time we send in the same period, we will wait a bit longer.
-                deltaFromPeriodStart = time.time() - self.SendPeriodStartSec
-                if deltaFromPeriodStart > EventHandler.c_SendPeriodWindowSec:
+                now = time.monotonic()
+                if now - self.SendPeriodStartSec > EventHandler.c_SendPeriodWindowSec:
                     # The last send was outside the window, so we are in a new period.
-                    self.SendPeriodStartSec = time.time()
+                    self.SendPeriodStartSec = now
                     self.SentCountThisPeriod = 1
-                    # This is the first send in a period, we sleep a shorter amount of time.
-                    # We still want to sleep some to collapse back-to-back events, but we want to be responsive.
-                    time.sleep(EventHandler.c_RequestCollapseDelayTimeSecFirstSend)
+                    # This is the first send in a period, we wait a shorter amount of time.
+                    # We still want to wait some to collapse back-to-back events, but we want to be responsive.
+                    collapseDelaySec = EventHandler.c_RequestCollapseDelayTimeSecFirstSend
                 else:
                     # We are in a send period.
                     # This might happen if the user is changing a lot of things rapidly. To prevent spamming, we want to back off event sends.
                     self.SentCountThisPeriod += 1
                     self.SentCountThisPeriod = min(self.SentCountThisPeriod, 3)
-                    time.sleep(EventHandler.c_RequestCollapseDelayTimeSec * self.SentCountThisPeriod)
+                    collapseDelaySec = EventHandler.c_RequestCollapseDelayTimeSec * self.SentCountThisPeriod
+
+                # If the startup_sync is waiting, don't delay it.
+                if self.StartupSyncPending:
+                    self.StartupSyncPending = False
+                    collapseDelaySec = 0.0
+
+                # Collect the events into this batch as they come in, until the collapse delay is up.
+                self._CollectPendingEvents(collapseDelaySec)
 
                 # Ensure we have an API key.
                 if self.HomewayApiKey is None or len(self.HomewayApiKey) == 0:
                     self.Logger.warn("We wanted to do a send state change events, but don't have an API key.")
-                    time.sleep(10.0)
+                    # Keep taking events while we wait, so they are collapsed and bounded in the pending events rather than piling up in the queue.
+                    self._CollectPendingEvents(10.0)
                     continue
 
-                # Now we collect what exists and send them.
-                sendEvents = []
-                with self.Lock:
-                    sendEvents = self.SendEvents
-                    self.SendEvents = []
+                # Now we collect anything else that has been queued and send them.
+                while True:
+                    try:
+                        self._AddPendingEvent(self.SendQueue.get_nowait())
+                    except queue.Empty:
+                        break
+                events = self.PendingEvents
+                self.PendingEvents = []
+                self.PendingUpdateIndexByEntity.clear()
 
-                self.Logger.debug(f"_StateChangeSender is sending {(len(sendEvents))} assistant state change events.")
+                self.Logger.debug("_StateChangeSender is sending %d assistant state change events.", len(events))
 
                 # Make the call.
-                url = "https://homeway.io/api/plugin-api/statechangeevents"
-                if self.DevLocalHomewayServerAddress_CanBeNone is not None:
-                    url = f"http://{self.DevLocalHomewayServerAddress_CanBeNone}/api/plugin-api/statechangeevents"
-                result = HttpSessions.GetSession(url).post(url, json={"PluginId": self.PluginId, "ApiKey": self.HomewayApiKey, "Events": sendEvents }, timeout=30)
+                # The session is shared per host, so the connection to the server is kept alive between sends.
+                url = self.StateChangeEventsUrl
+                body = {"PluginId": self.PluginId, "ApiKey": self.HomewayApiKey, "Events": events }
+                if orjson is not None:
+                    data = orjson.dumps(body, option=orjson.OPT_NON_STR_KEYS)
+                else:
+                    data = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                result = HttpSessions.GetSession(url).post(url, data=data, headers={"Content-Type": "application/json"}, timeout=(EventHandler.c_SendConnectTimeoutSec, EventHandler.c_SendReadTimeoutSec))
 
                 # Validate the response.
                 if result.status_code != 200:
-                    self.Logger.warn(f"Send Change Events failed, the API returned {result.status_code}")
-
+                    self.Logger.warn("Send Change Events failed, the API returned %s", result.status_code)
+
+            except (requests.exceptions.ConnectionError, ConnectionError, ssl.SSLError) as e:
+                # These are expected if the server can't be reached, so we don't need to report them.
+                self.Logger.warn("Homeway server is not reachable. Will try again later. %s", e)
+            except requests.exceptions.Timeout as e:
+                # This is expected if the server is slow to respond, since the send timeouts are short, so we don't need to report it.
+                self.Logger.warn("Homeway server timed out sending state change events. %s", e)
             except Exception as e:
-                if (e is ConnectionError or e is ssl.SSLError) and "Max retries exceeded with url" in str(e):
-                    self.Logger.error("Homeway server is not reachable. Will try again later.", e)
-                else:
-                    Sentry.Exception("_StateChangeSender exception", e)
-
+                Sentry.Exception("_StateChangeSender exception", e)
 
-    def _TempUnitsDetector(self):
-        startup = True
-        while True:
-            try:
-                # Run at startup, otherwise every hour.
-                if startup is False:
-                    time.sleep(60 * 60)
-                else:
-                    time.sleep(2.0)
-                startup = False
 
-                # Try to get the config API
-                configApiJson = ServerInfo.GetConfigApi(self.Logger, 30.0)
-                if configApiJson is None:
-                    self.Logger.warn("Get config API failed.")
-                    continue
+    # Gets the temp units from the HA config API.
+    def _DetectTempUnits(self):
+        try:
+            # Try to get the config API
+            configApiJson = ServerInfo.GetConfigApi(self.Logger, 30.0)
+            if configApiJson is None:
+                self.Logger.warn("Get config API failed.")
+                return
 
-                # Parse the result.
-                if "unit_system" not in configApiJson:
-                    self.Logger.warn("Get config API missing unit_system")
-                    continue
-                if "temperature" not in configApiJson["unit_system"]:
-                    self.Logger.warn("Get config API missing temperature")
-                    continue
+            # Parse the result.
+            if "unit_system" not in configApiJson:
+                self.Logger.warn("Get config API missing unit_system")
+                return
+            if "temperature" not in configApiJson["unit_system"]:
+                self.Logger.warn("Get config API missing temperature")
+                return
 
-                if configApiJson["unit_system"]["temperature"] == "°F":
-                    self.HaTempUnits = "F"
-                elif configApiJson["unit_system"]["temperature"] == "°C":
-                    self.HaTempUnits = "C"
-                else:
-                    self.Logger.warn(f"Get config API unknown temperature unit [{configApiJson['unit_system']['temperature']}]")
-            except Exception as e:
-                Sentry.Exception("_StateChangeSender exception", e)
+            if configApiJson["unit_system"]["temperature"] == "°F":
+                self.HaTempUnits = "F"
+            elif configApiJson["unit_system"]["temperature"] == "°C":
+                self.HaTempUnits = "C"
+            else:
+                self.Logger.warn("Get config API unknown temperature unit [%s]", configApiJson['unit_system']['temperature'])
+        except Exception as e:
+            Sentry.Exception("_DetectTempUnits exception", e)
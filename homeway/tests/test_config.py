@@ -0,0 +1,40 @@
+import unittest
+import configparser
+
+from homeway_linuxhost.config import Config
+
+# Config replaced configparser with a minimal parser, these make sure it still reads our files the same way configparser did.
+class TestConfigParse(unittest.TestCase):
+
+    def _AssertMatchesConfigParser(self, text:str) -> dict:
+        cp = configparser.ConfigParser()
+        cp.read_string(text)
+        expected = {s: dict(cp[s]) for s in cp.sections()}
+        result = Config._ParseConfig(text)
+        self.assertEqual(result, expected)
+        # Writing the config back out and reading it again must not change it.
+        self.assertEqual(Config._ParseConfig(Config._SerializeConfig(result)), result)
+        return result
+
+
+    def test_Basic(self):
+        result = self._AssertMatchesConfigParser("[home_assistant]\nhostname_or_ip = 127.0.0.1\nPort: 8123\n\n[logging]\n# comment\n; comment\nlog_level = INFO\n")
+        self.assertEqual(result["home_assistant"], {"hostname_or_ip": "127.0.0.1", "port": "8123"})
+
+
+    def test_UniformlyIndentedKeys(self):
+        result = self._AssertMatchesConfigParser("[home_assistant]\n  hostname_or_ip = 127.0.0.1\n  port = 8123\n\t\n  use_https = False\n")
+        self.assertEqual(result["home_assistant"], {"hostname_or_ip": "127.0.0.1", "port": "8123", "use_https": "False"})
+
+
+    def test_ContinuationLines(self):
+        result = self._AssertMatchesConfigParser("[sage]\nsage_prefix = first\n  second\n\n\tthird\n  # comment\n    fourth\n\nnext = 1\n\n")
+        self.assertEqual(result["sage"], {"sage_prefix": "first\nsecond\n\nthird\nfourth", "next": "1"})
+
+
+    def test_IndentedKeyContinuation(self):
+        self._AssertMatchesConfigParser("[s]\n  a = 1\n    more\n  b = 2\n[t]\n    c = 3\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,9 +27,14 @@ class ConfigFile:
     def UpdateConfig(context:Context, ip:str, port:str, accessToken:str):
         try:
             config = Config(context.AddonFolder)
-            config.SetStr(Config.HomeAssistantSection, Config.HaIpOrHostnameKey, ip)
-            config.SetStr(Config.HomeAssistantSection, Config.HaPortKey, port)
-            config.SetStr(Config.HomeAssistantSection, Config.HaAccessTokenKey, accessToken)
+            # Set all of the values at once, so the config is only written one time.
+            config.SetMany({
+                Config.HomeAssistantSection: {
+                    Config.HaIpOrHostnameKey: ip,
+                    Config.HaPortKey: port,
+                    Config.HaAccessTokenKey: accessToken,
+                }
+            })
             return True
         except Exception as e:
             Logger.Error("Failed to write config. "+str(e))